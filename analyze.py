@@ -9,10 +9,16 @@ of characters. The first character is a donor ID: 'A' means donor 0, 'B' means 1
 (failure).
 
 The placebo trials have one donor marked with character 'P'.
+
+Trials simulated from stratified donor lists (see donors.py) are analyzed per stratum,
+i.e., per number of efficacious donors, and the per-stratum power is combined with the
+stratum weights for any prevalence of efficacious donors.
 '''
 
 import numpy as np
 import scipy.stats
+from fmt_sim import donors as donors_mod
+from fmt_sim import simulate
 
 class memoize(dict):
     def __init__(self, func):
@@ -35,23 +41,58 @@ def clopper_pearson(x, n, conf=0.95):
     '''
 
     alpha = 1.0 - conf
-    lo = scipy.stats.beta.ppf(alpha / 2, x, n - x + 1)
-    hi = scipy.stats.beta.ppf(1.0 - alpha / 2, x + 1, n - x)
+    lo = scipy.stats.beta.ppf(alpha / 2, x, n - x + 1) if x > 0 else 0.0
+    hi = scipy.stats.beta.ppf(1.0 - alpha / 2, x + 1, n - x) if x < n else 1.0
     return (lo, hi)
 
 @memoize
-def fisher_exact_p(treatment_success, placebo_success, arm_size):
+def fisher_exact_p(treatment_success, placebo_success, arm_size, alternative='greater'):
     '''
     Fisher's exact test p-value when the number of patients in the two arms is the same
-    and the alternative hypothesis is "greater rate in treatment arm"
+    and the alternative hypothesis is "greater rate in treatment arm" (or 'two-sided')
     '''
 
     treatment_fail = arm_size - treatment_success
     placebo_fail = arm_size - placebo_success
     table = [[treatment_success, treatment_fail], [placebo_success, placebo_fail]]
-    oddsratio, p_value = scipy.stats.fisher_exact(table, alternative='greater')
+    oddsratio, p_value = scipy.stats.fisher_exact(table, alternative=alternative)
     return p_value
 
+@memoize
+def z_test_p(treatment_success, placebo_success, arm_size, alternative='greater'):
+    '''
+    Pooled two-proportion z-test p-value when the number of patients in the two arms is
+    the same, with alternative hypothesis "greater rate in treatment arm" (or 'two-sided')
+    '''
+
+    pooled = (treatment_success + placebo_success) / (2 * arm_size)
+    if pooled in [0.0, 1.0]:
+        # no variance, so no evidence of a difference
+        return 1.0
+
+    se = np.sqrt(pooled * (1.0 - pooled) * 2 / arm_size)
+    z = (treatment_success - placebo_success) / arm_size / se
+
+    if alternative == 'greater':
+        return scipy.stats.norm.sf(z)
+    elif alternative == 'two-sided':
+        return 2 * scipy.stats.norm.sf(abs(z))
+    else:
+        raise RuntimeError("don't recognize alternative '{}'".format(alternative))
+
+# tests available to power analyses, by name
+TESTS = {
+    'fisher': lambda tx, pl, n: fisher_exact_p(tx, pl, n, 'greater'),
+    'fisher2': lambda tx, pl, n: fisher_exact_p(tx, pl, n, 'two-sided'),
+    'z': lambda tx, pl, n: z_test_p(tx, pl, n, 'greater'),
+    'z2': lambda tx, pl, n: z_test_p(tx, pl, n, 'two-sided'),
+}
+
+def check_tests(tests):
+    for test in tests:
+        if test not in TESTS:
+            raise RuntimeError("don't recognize test '{}'; choose from {}".format(test, sorted(TESTS)))
+
 def parse_history_line(line):
     if not set(line.rstrip()[1::2]) <= {'s', 'f'}:
         raise RuntimeError("history line '{}' does not have appropriate 's' and 'f' markers".format(line.rstrip()))
@@ -63,27 +104,241 @@ def parse_history_line(line):
     n_total = len(line.rstrip()) // 2
     return n_successes, n_total
 
-def power(treatment_history, placebo_history, conf=0.95):
+def donor_counts(line):
+    '''(patients, successes) per donor index in a (validated) history line'''
+    chars = np.frombuffer(line.rstrip().encode('latin-1'), dtype=np.uint8)
+    donor_is = chars[0::2].astype(int) - 65
+    successes = chars[1::2] == ord('s')
+    return np.bincount(donor_is), np.bincount(donor_is, weights=successes)
+
+def add_counts(total, counts):
+    if len(counts) > len(total):
+        total = np.pad(total, (0, len(counts) - len(total)))
+
+    total[0: len(counts)] += counts
+    return total
+
+def power_table(treatment_history, placebo_history, alphas=[0.05], tests=['fisher'], conf=0.95, donors=False):
+    '''
+    Power for every combination of test and alpha, plus (if donors) the treatment arm's
+    allocations and successes per donor, from a single pass over the paired histories.
+
+    Returns a list of rows (kind, name, alpha, n, successes, lo, estimate, hi). "power"
+    rows count significant trials out of all trials; "donor" rows count successes out
+    of patients allocated to that donor. lo and hi are Clopper-Pearson intervals.
+    '''
+    check_tests(tests)
+
     total_trials = 0
-    significant_trials = 0
+    significant_trials = {(test, alpha): 0 for test in tests for alpha in alphas}
+    donor_patients = np.zeros(0)
+    donor_successes = np.zeros(0)
+
     for tx_line, pl_line in zip(treatment_history, placebo_history):
         n_tx_succ, n_tx_total = parse_history_line(tx_line)
         n_pl_succ, n_pl_total = parse_history_line(pl_line)
         assert n_tx_total == n_pl_total
-        p = fisher_exact_p(n_tx_succ, n_pl_succ, n_tx_total)
 
-        if p < 0.05:
-            significant_trials += 1
+        for test in tests:
+            p = TESTS[test](n_tx_succ, n_pl_succ, n_tx_total)
+            for alpha in alphas:
+                if p < alpha:
+                    significant_trials[(test, alpha)] += 1
+
+        if donors:
+            patients, successes = donor_counts(tx_line)
+            donor_patients = add_counts(donor_patients, patients)
+            donor_successes = add_counts(donor_successes, successes)
 
         total_trials += 1
 
     if total_trials == 0:
         raise RuntimeError("can't compute power on empty file")
 
-    center = significant_trials / total_trials
-    lo, hi = clopper_pearson(significant_trials, total_trials, conf=conf)
+    rows = []
+    for test in tests:
+        for alpha in alphas:
+            x = significant_trials[(test, alpha)]
+            lo, hi = clopper_pearson(x, total_trials, conf=conf)
+            rows.append(('power', test, alpha, total_trials, x, lo, x / total_trials, hi))
+
+    for donor_i, (n, x) in enumerate(zip(donor_patients.astype(int), donor_successes.astype(int))):
+        if n > 0:
+            lo, hi = clopper_pearson(x, n, conf=conf)
+            rows.append(('donor', chr(65 + donor_i), None, n, x, lo, x / n, hi))
+
+    return rows
+
+def power(treatment_history, placebo_history, conf=0.95, alpha=0.05, test='fisher'):
+    rows = power_table(treatment_history, placebo_history, [alpha], [test], conf=conf)
+    kind, name, alpha, n, x, lo, center, hi = rows[0]
     return (lo, center, hi)
 
-def write_power(treatment_history, placebo_history, output):
-    lo, center, hi = power(treatment_history, placebo_history)
-    print("\t".join([str(x) for x in [lo, center, hi]]), file=output)
+def write_power(treatment_history, placebo_history, output, alphas=[0.05], tests=['fisher'], donors=False):
+    '''
+    With one test, one alpha, and no donor summaries, write "lo, power, hi". Otherwise,
+    write a table with a header and one row per power estimate and per donor.
+    '''
+    rows = power_table(treatment_history, placebo_history, alphas, tests, donors=donors)
+
+    if len(alphas) == 1 and len(tests) == 1 and not donors:
+        kind, name, alpha, n, x, lo, center, hi = rows[0]
+        print("\t".join([str(x) for x in [lo, center, hi]]), file=output)
+    else:
+        print("\t".join(['kind', 'name', 'alpha', 'n', 'successes', 'lo', 'estimate', 'hi']), file=output)
+        for row in rows:
+            print("\t".join(['NA' if x is None else str(x) for x in row]), file=output)
+
+STRATUM_COLUMNS = ['kind', 'test', 'alpha', 'ped', 'k', 'n', 'successes', 'lo', 'estimate', 'hi']
+
+def stratified_ci(x, n, weights, conf=0.95):
+    '''
+    Stratified estimate of a proportion, from successes x and trials n per stratum.
+
+    The interval is Korn and Graubard's: Clopper-Pearson at the effective sample size
+    p(1 - p) / variance, scaled by (t[n - 1] / t[df]) ** 2 for n trials in H strata with
+    df = n - H (at least 1). The effective size isn't truncated at n, so the variance
+    reduction from stratifying carries over to the interval. If no stratum varies (each
+    is at 0 or 1), the effective size is taken to be n.
+    '''
+    x = np.asarray(x, dtype=float)
+    n = np.asarray(n, dtype=float)
+    weights = np.asarray(weights, dtype=float)
+
+    missing = (weights > 0) & (n == 0)
+    if np.any(missing):
+        raise RuntimeError("strata {} have positive weight but no trials".format(list(np.flatnonzero(missing))))
+
+    used = weights > 0
+    p = x[used] / n[used]
+    center = np.sum(weights[used] * p)
+    variance = np.sum(weights[used] ** 2 * p * (1.0 - p) / n[used])
+
+    n_total = n[used].sum()
+    if variance > 0:
+        n_eff = center * (1.0 - center) / variance
+    else:
+        n_eff = n_total
+
+    # degrees-of-freedom adjustment for estimating the variance from the strata
+    df = max(n_total - used.sum(), 1)
+    t_quantile = 1.0 - (1.0 - conf) / 2
+    n_eff *= (scipy.stats.t.ppf(t_quantile, n_total - 1) / scipy.stats.t.ppf(t_quantile, df)) ** 2
+
+    lo, hi = clopper_pearson(center * n_eff, n_eff, conf=conf)
+    return (lo, center, hi)
+
+def power_by_stratum(treatment_history, placebo_history, donors, alphas=[0.05], tests=['fisher'], n_donors=None):
+    '''
+    Significant trials and all trials per stratum, from one pass over the paired
+    histories and the donor list they were simulated from. If the treatment arm only
+    used the first n_donors donors, strata count efficacious donors among those.
+
+    Returns (donors_per_trial, n, {(test, alpha): x}), where n[k] and x[k] count trials
+    with k efficacious donors.
+    '''
+    check_tests(tests)
+
+    donors_per_trial = None
+    n = None
+    x = {}
+
+    for qualities, tx_line, pl_line in zip(donors_mod.parse(donors), treatment_history, placebo_history):
+        qualities = simulate.check_n_donors(qualities, n_donors)
+
+        if donors_per_trial is None:
+            donors_per_trial = len(qualities)
+            n = np.zeros(donors_per_trial + 1, dtype=int)
+            x = {(test, alpha): np.zeros(donors_per_trial + 1, dtype=int) for test in tests for alpha in alphas}
+        elif len(qualities) != donors_per_trial:
+            raise RuntimeError("stratified analysis needs the same number of donors in every trial")
+
+        n_tx_succ, n_tx_total = parse_history_line(tx_line)
+        n_pl_succ, n_pl_total = parse_history_line(pl_line)
+        assert n_tx_total == n_pl_total
+
+        k = sum(qualities)
+        for test in tests:
+            p = TESTS[test](n_tx_succ, n_pl_succ, n_tx_total)
+            for alpha in alphas:
+                if p < alpha:
+                    x[(test, alpha)][k] += 1
+
+        n[k] += 1
+
+    if donors_per_trial is None:
+        raise RuntimeError("can't compute power on empty file")
+
+    return donors_per_trial, n, x
+
+def stratified_power_rows(donors_per_trial, n, x, peds, conf=0.95):
+    '''
+    One combined "power" row per test, alpha, and ped. Their successes are NA, since
+    the weighted estimate isn't a count of significant trials.
+    '''
+    rows = []
+    for (test, alpha), x_k in x.items():
+        for ped in peds:
+            weights = donors_mod.stratum_weights(donors_per_trial, ped)
+            lo, center, hi = stratified_ci(x_k, n, weights, conf=conf)
+            rows.append(('power', test, alpha, ped, None, int(n[weights > 0].sum()), None, lo, center, hi))
+
+    return rows
+
+def print_stratum_table(rows, output):
+    print("\t".join(STRATUM_COLUMNS), file=output)
+    for row in rows:
+        print("\t".join(['NA' if x is None else str(x) for x in row]), file=output)
+
+def write_stratified_power(treatment_history, placebo_history, donors, peds, output, alphas=[0.05], tests=['fisher'], n_donors=None, conf=0.95):
+    '''
+    Write a table with one "stratum" row per test, alpha and stratum, and one combined
+    "power" row per test, alpha and ped. The stratum rows can be reweighted for other
+    peds later with write_reweighted.
+    '''
+    donors_per_trial, n, x = power_by_stratum(treatment_history, placebo_history, donors, alphas, tests, n_donors)
+
+    rows = []
+    for (test, alpha), x_k in x.items():
+        # keep empty strata, so the table records the number of donors per trial
+        for k in range(donors_per_trial + 1):
+            if n[k] > 0:
+                lo, hi = clopper_pearson(x_k[k], n[k], conf=conf)
+                center = x_k[k] / n[k]
+            else:
+                lo, center, hi = None, None, None
+
+            rows.append(('stratum', test, alpha, None, k, int(n[k]), int(x_k[k]), lo, center, hi))
+
+    rows += stratified_power_rows(donors_per_trial, n, x, peds, conf=conf)
+    print_stratum_table(rows, output)
+
+def parse_stratum_table(table):
+    '''(donors_per_trial, n, x) from the stratum rows of a stratified power table'''
+    lines = iter(table)
+    header = next(lines, "").rstrip("\n").split("\t")
+    if header != STRATUM_COLUMNS:
+        raise RuntimeError("not a stratified power table")
+
+    strata = []
+    for line in lines:
+        row = dict(zip(STRATUM_COLUMNS, line.rstrip("\n").split("\t")))
+        if row['kind'] == 'stratum':
+            strata.append((row['test'], float(row['alpha']), int(row['k']), int(row['n']), int(row['successes'])))
+
+    if len(strata) == 0:
+        raise RuntimeError("stratified power table has no stratum rows")
+
+    donors_per_trial = max(k for test, alpha, k, n_k, x_k in strata)
+    n = np.zeros(donors_per_trial + 1, dtype=int)
+    x = {}
+    for test, alpha, k, n_k, x_k in strata:
+        n[k] = n_k
+        x.setdefault((test, alpha), np.zeros(donors_per_trial + 1, dtype=int))[k] = x_k
+
+    return donors_per_trial, n, x
+
+def write_reweighted(table, peds, output, conf=0.95):
+    '''combined power for new peds from a stratified power table, without the histories'''
+    donors_per_trial, n, x = parse_stratum_table(table)
+    print_stratum_table(stratified_power_rows(donors_per_trial, n, x, peds, conf=conf), output)
@@ -0,0 +1,121 @@
+# author: scott olesen <swo@mit.edu>
+
+'''
+Content-addressed cache of command outputs.
+
+Each entry is the exact output of one command. The key is a hash of the command, its
+parameters, the content of its donor list (if any), and the RNG seed. Only seeded runs
+are cached, since unseeded runs are not meant to be repeatable. Entries are evicted
+least-recently-used first when the cache grows past its size cap.
+'''
+
+import hashlib, io, json, os, shutil, tempfile
+
+DEFAULT_DIR = os.environ.get('FMT_SIM_CACHE', os.path.join(os.path.expanduser('~'), '.cache', 'fmt_sim'))
+DEFAULT_MAX_MB = 1024
+
+# bump when the output of any command changes for the same inputs
+VERSION = 1
+
+def file_digest(fn, block_size=1 << 20):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        for block in iter(lambda: f.read(block_size), b''):
+            h.update(block)
+
+    return h.hexdigest()
+
+def key(command, params, seed, donors=None):
+    if seed is None:
+        raise RuntimeError("can't cache results without a seed")
+
+    if donors is None:
+        donors_digest = None
+    elif os.path.isfile(getattr(donors, 'name', '')):
+        donors_digest = file_digest(donors.name)
+    else:
+        raise RuntimeError("can't cache results from a donor list that isn't a file")
+
+    content = json.dumps([VERSION, command, sorted(params.items()), seed, donors_digest])
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def entries(cache_dir):
+    '''(path, size, last use) of every entry'''
+    if not os.path.isdir(cache_dir):
+        return []
+
+    result = []
+    for fn in os.listdir(cache_dir):
+        if fn.endswith('.out'):
+            path = os.path.join(cache_dir, fn)
+            st = os.stat(path)
+            result.append((path, st.st_size, st.st_mtime))
+
+    return result
+
+def prune(cache_dir=DEFAULT_DIR, max_mb=DEFAULT_MAX_MB):
+    '''evict least-recently-used entries until the cache fits in max_mb; returns # evicted'''
+    max_bytes = max_mb * (1 << 20)
+    current = entries(cache_dir)
+    total = sum(size for path, size, mtime in current)
+
+    n_evicted = 0
+    for path, size, mtime in sorted(current, key=lambda e: e[2]):
+        if total <= max_bytes:
+            break
+
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another process got it first
+            pass
+
+        total -= size
+        n_evicted += 1
+
+    return n_evicted
+
+def copy_entry(f, output):
+    '''copy bytes underneath text streams like stdout; in-memory text streams get text'''
+    if hasattr(output, 'buffer'):
+        output.flush()
+        shutil.copyfileobj(f, output.buffer)
+    elif isinstance(output, io.TextIOBase):
+        shutil.copyfileobj(io.TextIOWrapper(f), output)
+    else:
+        shutil.copyfileobj(f, output)
+
+def run(func, opts, command, seed, cache_dir=DEFAULT_DIR, max_mb=DEFAULT_MAX_MB):
+    '''
+    Call func(**opts), serving its output from the cache on a hit. Returns True on a hit.
+    '''
+    params = {k: v for k, v in opts.items() if k not in ['output', 'donors']}
+    path = os.path.join(cache_dir, key(command, params, seed, opts.get('donors')) + '.out')
+    output = opts['output']
+
+    try:
+        with open(path, 'rb') as f:
+            # mark as recently used
+            os.utime(path)
+            copy_entry(f, output)
+        return True
+    except FileNotFoundError:
+        pass
+
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+    try:
+        with open(fd, 'w') as tmp:
+            func(**dict(opts, output=tmp))
+
+        # atomic, so concurrent runs never see partial entries
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+    with open(path, 'rb') as f:
+        copy_entry(f, output)
+
+    prune(cache_dir, max_mb)
+    return False
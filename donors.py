@@ -5,29 +5,198 @@ Generate and parse donor lists.
 
 Donor lists are newline-separated entries. Each entry consists of a string of 0's and 1's,
 one character per donor. "0" means "inefficacious donor"; "1" means "efficacious donor".
+
+Stratified donor lists hold a chosen number of trials for each number k of efficacious
+donors, with the efficacious donors in random positions. Within a stratum, these lists
+have the same distribution as i.i.d. lists that happen to have k efficacious donors, so
+analyze can weight per-stratum results by the binomial(donors_per_trial, ped) weights.
+
+Donor lists can also be written in a bit-packed binary format: a fixed header (magic
+string, number of donors per trial, number of trials) followed by one np.packbits row
+per trial. Packed lists are read through a memory map, so they are never loaded whole.
 '''
 
 import numpy as np
-import warnings
+import io, math, os, struct, sys, warnings
+
+# number of trials generated or unpacked at once
+CHUNK_SIZE = 10000
+
+PACKED_MAGIC = b'FMTDONOR'
+# magic, donors per trial, number of trials
+PACKED_HEADER = struct.Struct('<8sIQ')
+
+class PackedDonors:
+    '''Memory-mapped bit-packed donor list'''
+    def __init__(self, fn, chunk_size=CHUNK_SIZE):
+        with open(fn, 'rb') as f:
+            header = f.read(PACKED_HEADER.size)
+
+        if len(header) < PACKED_HEADER.size:
+            raise RuntimeError("packed donor file '{}' has a truncated header".format(fn))
+
+        magic, self.donors_per_trial, self.n_trials = PACKED_HEADER.unpack(header)
+        if magic != PACKED_MAGIC:
+            raise RuntimeError("file '{}' is not a packed donor list".format(fn))
+
+        self.name = fn
+        self.chunk_size = chunk_size
+        row_bytes = (self.donors_per_trial + 7) // 8
+
+        if self.n_trials == 0:
+            self.rows = np.zeros((0, row_bytes), dtype=np.uint8)
+        else:
+            self.rows = np.memmap(fn, dtype=np.uint8, mode='r', offset=PACKED_HEADER.size, shape=(self.n_trials, row_bytes))
+
+    def __len__(self):
+        return self.n_trials
+
+    def chunks(self, chunk_size=None):
+        '''unpacked (trials, donors) arrays of at most chunk_size trials [default: as opened]'''
+        if chunk_size is None:
+            chunk_size = self.chunk_size
+
+        for start in range(0, self.n_trials, chunk_size):
+            packed = self.rows[start: start + chunk_size]
+            yield np.unpackbits(packed, axis=1, count=self.donors_per_trial)
+
+    def __iter__(self):
+        for chunk in self.chunks():
+            yield from chunk
+
+def is_packed(f):
+    '''check the magic string without consuming it, so pipes can still be read as text'''
+    return f.peek(len(PACKED_MAGIC))[0: len(PACKED_MAGIC)] == PACKED_MAGIC
+
+def open_donors(fn):
+    '''open a donor list, either text or packed; "-" means stdin'''
+    if fn == '-':
+        return sys.stdin
+
+    f = open(fn, 'rb')
+    if is_packed(f):
+        f.close()
+        if not os.path.isfile(fn):
+            # a memory map needs a regular file, not a pipe or FIFO
+            raise RuntimeError("packed donor list '{}' must be a regular file".format(fn))
 
-def generate(donors_per_trial, n_trials, ped):
-    for donors in np.random.binomial(1, ped, size=(n_trials, donors_per_trial)):
-        line = "".join([str(d) for d in donors]) + "\n"
-        yield line
+        return PackedDonors(fn)
+    else:
+        return io.TextIOWrapper(f)
+
+def generate_chunks(donors_per_trial, n_trials, ped, chunk_size=CHUNK_SIZE):
+    for start in range(0, n_trials, chunk_size):
+        size = min(chunk_size, n_trials - start)
+        yield np.random.binomial(1, ped, size=(size, donors_per_trial)).astype(np.uint8)
+
+def stratum_weights(donors_per_trial, ped):
+    '''probability of k efficacious donors, for k = 0, ..., donors_per_trial'''
+    return np.array([math.comb(donors_per_trial, k) * ped ** k * (1.0 - ped) ** (donors_per_trial - k) for k in range(donors_per_trial + 1)])
+
+def allocate(donors_per_trial, n_trials, ped, method='equal'):
+    '''
+    Number of trials per stratum. "equal" splits trials evenly over all strata, so
+    results can be reweighted for any ped. "proportional" follows the stratum weights
+    for this ped, with at least one trial in every stratum of positive weight.
+    '''
+    n_strata = donors_per_trial + 1
+
+    if method == 'equal':
+        counts = np.full(n_strata, n_trials // n_strata)
+        counts[0: n_trials % n_strata] += 1
+    elif method == 'proportional':
+        weights = stratum_weights(donors_per_trial, ped)
+        counts = np.floor(weights * n_trials).astype(int)
+        # hand out the remainder by largest fractional part
+        remainder = n_trials - counts.sum()
+        counts[np.argsort(counts - weights * n_trials)[0: remainder]] += 1
+        counts[(weights > 0) & (counts == 0)] = 1
+    else:
+        raise RuntimeError("don't recognize allocation method '{}'".format(method))
+
+    return counts
+
+def generate_stratified_chunks(donors_per_trial, counts, chunk_size=CHUNK_SIZE):
+    '''counts[k] trials with exactly k efficacious donors, in random positions'''
+    for k, n_trials in enumerate(counts):
+        for start in range(0, n_trials, chunk_size):
+            size = min(chunk_size, n_trials - start)
+            ranks = np.argsort(np.random.random((size, donors_per_trial)), axis=1)
+            yield (ranks < k).astype(np.uint8)
+
+def format_chunk(chunk):
+    '''render a (trials, donors) array of 0's and 1's as donor list lines'''
+    chars = np.empty((chunk.shape[0], chunk.shape[1] + 1), dtype=np.uint8)
+    chars[:, :-1] = chunk + ord('0')
+    chars[:, -1] = ord('\n')
+    return chars.tobytes().decode('ascii')
+
+def generate(donors_per_trial, n_trials, ped, chunk_size=CHUNK_SIZE):
+    for chunk in generate_chunks(donors_per_trial, n_trials, ped, chunk_size):
+        yield from format_chunk(chunk).splitlines(keepends=True)
+
+def warn_n_donors(n_donors):
+    if n_donors > 60:
+        warnings.warn("you are using {} donors; IDs for donors after 60 are unprintable".format(n_donors), UserWarning)
+
+def parse_line(line):
+    line = line.rstrip()
+
+    if not set(line) <= {'0', '1'}:
+        if not line.isdecimal():
+            raise ValueError("non-digit in donor quality line: {}".format(line))
+        else:
+            raise RuntimeError("malformed donor quality line: {}".format(line))
+
+    return (np.frombuffer(line.encode('ascii'), dtype=np.uint8) - ord('0')).tolist()
 
 def parse(donors):
-    for line in donors:
-        values = [int(x) for x in line.rstrip()]
+    # fmt.py and fmt_sim can load this module twice, so don't rely on isinstance
+    if hasattr(donors, 'donors_per_trial'):
+        warn_n_donors(donors.donors_per_trial)
+        for row in donors:
+            yield row.tolist()
+    else:
+        for line in donors:
+            values = parse_line(line)
+            warn_n_donors(len(values))
+            yield values
+
+def parse_chunks(donors, chunk_size=CHUNK_SIZE):
+    '''(trials, donors) arrays of up to chunk_size consecutive trials with the same number of donors'''
+    if hasattr(donors, 'donors_per_trial'):
+        warn_n_donors(donors.donors_per_trial)
+        yield from donors.chunks(chunk_size)
+        return
+
+    chunk = []
+    for values in parse(donors):
+        if chunk and (len(values) != len(chunk[0]) or len(chunk) == chunk_size):
+            yield np.array(chunk, dtype=np.uint8)
+            chunk = []
+
+        chunk.append(values)
 
-        for x in values:
-            if x not in [0, 1]:
-                raise RuntimeError("malformed donor quality line: {}".format(line.rstrip()))
+    if chunk:
+        yield np.array(chunk, dtype=np.uint8)
 
-        if len(values) > 60:
-            warnings.warn("you are using {} donors; IDs for donors after 60 are unprintable".format(len(values)), UserWarning)
+def write(donors_per_trial, n_trials, ped, output, packed=False, stratify=None, chunk_size=CHUNK_SIZE):
+    if stratify is None:
+        chunks = generate_chunks(donors_per_trial, n_trials, ped, chunk_size)
+    else:
+        counts = allocate(donors_per_trial, n_trials, ped, stratify)
+        n_trials = int(counts.sum())
+        chunks = generate_stratified_chunks(donors_per_trial, counts, chunk_size)
 
-        yield values
+    if packed:
+        # write bytes underneath text streams like stdout
+        if hasattr(output, 'buffer'):
+            output.flush()
+            output = output.buffer
 
-def write(donors_per_trial, n_trials, ped, output):
-    for line in generate(donors_per_trial, n_trials, ped):
-        output.write(line)
+        output.write(PACKED_HEADER.pack(PACKED_MAGIC, donors_per_trial, n_trials))
+        for chunk in chunks:
+            output.write(np.packbits(chunk, axis=1).tobytes())
+    else:
+        for chunk in chunks:
+            output.write(format_chunk(chunk))
@@ -6,50 +6,89 @@
 command-line interface
 '''
 
-import argparse, sys
-import donors, simulate, analyze
+import argparse, importlib, os, sys
+import cache
+
+# subcommand modules (and numpy, scipy, etc. through them) are imported only when
+# the selected command needs them, so small invocations start quickly
+
+# names of analyze.TESTS, which can't be imported here without loading scipy
+TESTS = ['fisher', 'fisher2', 'z', 'z2']
+
+def resolve(func):
+    '''import "module.function" for the selected command'''
+    module_name, func_name = func.rsplit('.', 1)
+    return getattr(importlib.import_module(module_name), func_name)
+
+def donor_list(fn):
+    try:
+        return resolve('donors.open_donors')(fn)
+    except OSError as e:
+        # same usage error as argparse.FileType
+        raise argparse.ArgumentTypeError("can't open '{}': {}".format(fn, e))
+
+def donor_path(fn):
+    '''name of a donor list that is opened later, once per reader'''
+    if fn != '-':
+        try:
+            open(fn, 'rb').close()
+        except OSError as e:
+            raise argparse.ArgumentTypeError("can't open '{}': {}".format(fn, e))
+
+    if not os.path.isfile(fn):
+        raise argparse.ArgumentTypeError("the pipeline reads the donor list twice, so it must be a regular file, not stdin or a pipe")
+
+    return fn
 
 def parse_args(args=None):
     parser = argparse.ArgumentParser(description='simulate and analyze FMT trials')
     cmd_parsers = parser.add_subparsers(title='commands', metavar='cmd')
 
-    p = cmd_parsers.add_parser('donors', help='generate donor lists')
+    # options shared by the commands that draw random numbers
+    rp = argparse.ArgumentParser(add_help=False)
+    rp.add_argument('--seed', type=int, default=None, help='RNG seed')
+    rp.add_argument('--cache', nargs='?', const=cache.DEFAULT_DIR, default=None, metavar='DIR', help='reuse cached output of identical seeded runs? [default dir: {}]'.format(cache.DEFAULT_DIR))
+    rp.add_argument('--cache_max_mb', type=float, default=cache.DEFAULT_MAX_MB, help='evict least recently used cache entries beyond this size [default: %(default)s]')
+
+    p = cmd_parsers.add_parser('donors', parents=[rp], help='generate donor lists')
     p.add_argument('donors_per_trial', type=int)
     p.add_argument('n_trials', type=int)
     p.add_argument('ped', type=float, help='prevalence of efficacious donors')
+    p.add_argument('--packed', action='store_true', help='write bit-packed binary donor list?')
+    p.add_argument('--stratify', choices=['equal', 'proportional'], default=None, help='allocate trials to strata of number of efficacious donors, equally or by weight for this ped?')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='donor list')
-    p.set_defaults(func=donors.write)
+    p.set_defaults(func='donors.write')
 
     p = cmd_parsers.add_parser('simulate', help='simulate trials')
     sp = p.add_subparsers()
 
-    p = sp.add_parser('placebo', help='simulate "one-donor" placebo group')
+    p = sp.add_parser('placebo', parents=[rp], help='simulate "one-donor" placebo group')
     p.add_argument('n_trials', type=int)
     p.add_argument('n_patients', type=int)
     p.add_argument('p_placebo', type=float, help='placebo response rate')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
-    p.set_defaults(func=simulate.write_placebo)
+    p.set_defaults(func='simulate.write_placebo')
 
-    p = sp.add_parser('block', help='assign donors to patients in blocks')
-    p.add_argument('donors', type=argparse.FileType('r'), help='donor list')
+    p = sp.add_parser('block', parents=[rp], help='assign donors to patients in blocks')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
     p.add_argument('n_patients', type=int)
     p.add_argument('p_placebo', type=float, help='placebo response rate')
     p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
     p.add_argument('--n_donors', type=int, default=None, help='specify a limited number of donors? [default: use all donors]')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
-    p.set_defaults(func=simulate.write_block)
+    p.set_defaults(func='simulate.write_block')
 
-    p = sp.add_parser('random', help='randomly assign donors')
-    p.add_argument('donors', type=argparse.FileType('r'), help='donor list')
+    p = sp.add_parser('random', parents=[rp], help='randomly assign donors')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
     p.add_argument('n_patients', type=int)
     p.add_argument('p_placebo', type=float, help='placebo response rate')
     p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
     p.add_argument('--n_donors', type=int, default=None, help='specify a limited number of donors? [default: use all donors]')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
-    p.set_defaults(func=simulate.write_random)
+    p.set_defaults(func='simulate.write_random')
 
-    p = sp.add_parser('urn', help='assign donors with a Polya urn')
-    p.add_argument('donors', type=argparse.FileType('r'), help='donor list')
+    p = sp.add_parser('urn', parents=[rp], help='assign donors with a Polya urn')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
     p.add_argument('n_patients', type=int)
     p.add_argument('p_placebo', type=float, help='placebo response rate')
     p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
@@ -58,29 +97,120 @@ def parse_args(args=None):
     p.add_argument('n_balls_penalty', type=int, help='number of balls to give to other donors after a failure')
     p.add_argument('--no_replace', action='store_true', help='do not replace drawn ball?')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
-    p.set_defaults(func=simulate.write_urn)
+    p.set_defaults(func='simulate.write_urn')
 
-    p = sp.add_parser('bayesian', help='assign donors with myopic Bayesian algorithm (flat prior)')
-    p.add_argument('donors', type=argparse.FileType('r'), help='donor list')
+    p = sp.add_parser('bayesian', parents=[rp], help='assign donors with myopic Bayesian algorithm (flat prior)')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
     p.add_argument('n_patients', type=int)
     p.add_argument('p_placebo', type=float, help='placebo response rate')
     p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
-    p.set_defaults(func=simulate.write_bayesian)
+    p.set_defaults(func='simulate.write_bayesian')
+
+    p = sp.add_parser('thompson', parents=[rp], help='assign donors by Thompson sampling from Beta posteriors')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
+    p.add_argument('n_patients', type=int)
+    p.add_argument('p_placebo', type=float, help='placebo response rate')
+    p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
+    p.add_argument('--prior', type=float, nargs=2, default=[1.0, 1.0], metavar=('A', 'B'), help='Beta prior on donor success rates [default: 1 1]')
+    p.add_argument('--n_donors', type=int, default=None, help='specify a limited number of donors? [default: use all donors]')
+    p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
+    p.set_defaults(func='simulate.write_thompson')
+
+    p = sp.add_parser('greedy', parents=[rp], help='assign donors by greatest Beta posterior mean (or upper bound)')
+    p.add_argument('donors', type=donor_list, help='donor list (text or packed)')
+    p.add_argument('n_patients', type=int)
+    p.add_argument('p_placebo', type=float, help='placebo response rate')
+    p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
+    p.add_argument('--prior', type=float, nargs=2, default=[1.0, 1.0], metavar=('A', 'B'), help='Beta prior on donor success rates [default: 1 1]')
+    p.add_argument('--ucb', type=float, default=0.0, help='add this many posterior standard deviations to the mean [default: 0, i.e., greedy]')
+    p.add_argument('--n_donors', type=int, default=None, help='specify a limited number of donors? [default: use all donors]')
+    p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='trial history')
+    p.set_defaults(func='simulate.write_greedy')
 
     p = cmd_parsers.add_parser('power', help='power')
     p.add_argument('treatment_history', type=argparse.FileType('r'), help='trial history from treatment arm')
     p.add_argument('placebo_history', type=argparse.FileType('r'), help='trial history from placebo arm')
+    p.add_argument('--alphas', type=float, nargs='+', default=[0.05], help='significance levels [default: 0.05]')
+    p.add_argument('--tests', nargs='+', default=['fisher'], choices=TESTS, help='one-sided (fisher, z) or two-sided (fisher2, z2) Fisher exact or two-proportion z-tests [default: fisher]')
+    p.add_argument('--donors', action='store_true', help='include allocations and successes per treatment donor?')
+    p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='power report')
+    p.set_defaults(func='analyze.write_power')
+
+    p = cmd_parsers.add_parser('stratified_power', help='power from stratified donor lists, combined for each ped')
+    p.add_argument('treatment_history', type=argparse.FileType('r'), help='trial history from treatment arm')
+    p.add_argument('placebo_history', type=argparse.FileType('r'), help='trial history from placebo arm')
+    p.add_argument('donors', type=donor_list, help='stratified donor list the treatment arm was simulated from')
+    p.add_argument('--peds', type=float, nargs='+', required=True, help='prevalences of efficacious donors to combine strata for')
+    p.add_argument('--n_donors', type=int, default=None, help='number of donors the treatment arm was limited to, if any [default: all donors]')
+    p.add_argument('--alphas', type=float, nargs='+', default=[0.05], help='significance levels [default: 0.05]')
+    p.add_argument('--tests', nargs='+', default=['fisher'], choices=TESTS, help='tests, as for power [default: fisher]')
+    p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='stratified power table')
+    p.set_defaults(func='analyze.write_stratified_power')
+
+    p = cmd_parsers.add_parser('reweight', help='combine strata of a stratified power table for other peds')
+    p.add_argument('table', type=argparse.FileType('r'), help='output of stratified_power')
+    p.add_argument('--peds', type=float, nargs='+', required=True, help='prevalences of efficacious donors')
+    p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='power table')
+    p.set_defaults(func='analyze.write_reweighted')
+
+    p = cmd_parsers.add_parser('pipeline', help='simulate both arms and compute power in one streaming run')
+    p.add_argument('strategy', choices=['block', 'random', 'urn', 'bayesian', 'thompson', 'greedy'], help='treatment arm strategy')
+    p.add_argument('donors', type=donor_path, help='donor list (text or packed)')
+    p.add_argument('n_patients', type=int)
+    p.add_argument('p_placebo', type=float, help='placebo response rate')
+    p.add_argument('p_eff', type=float, help='efficacious treatment response rate')
+    p.add_argument('--n_donors', type=int, default=None, help='specify a limited number of donors (not urn, bayesian)? [default: use all donors]')
+    p.add_argument('--urn', type=int, nargs=3, default=None, metavar=('N_BALLS0', 'REWARD', 'PENALTY'), help='urn ball numbers (urn)')
+    p.add_argument('--no_replace', action='store_true', help='do not replace drawn ball (urn)?')
+    p.add_argument('--prior', type=float, nargs=2, default=[1.0, 1.0], metavar=('A', 'B'), help='Beta prior on donor success rates (thompson, greedy) [default: 1 1]')
+    p.add_argument('--ucb', type=float, default=0.0, help='posterior standard deviations added to the mean (greedy) [default: 0]')
+    p.add_argument('--alphas', type=float, nargs='+', default=[0.05], help='significance levels [default: 0.05]')
+    p.add_argument('--tests', nargs='+', default=['fisher'], choices=TESTS, help='tests, as for power [default: fisher]')
+    p.add_argument('--donor_summary', action='store_true', help='include allocations and successes per treatment donor?')
+    p.add_argument('--treatment_output', type=argparse.FileType('w'), default=None, help='also keep treatment arm history?')
+    p.add_argument('--placebo_output', type=argparse.FileType('w'), default=None, help='also keep placebo arm history?')
+    p.add_argument('--queue_size', type=int, default=8, help='chunks buffered between simulation and analysis [default: %(default)s]')
+    p.add_argument('--seed', type=int, default=None, help='RNG seed')
     p.add_argument('--output', '-o', type=argparse.FileType('w'), default=sys.stdout, help='power report')
-    p.set_defaults(func=analyze.write_power)
+    p.set_defaults(func='pipeline.write_pipeline')
+
+    p = cmd_parsers.add_parser('cache', help='manage the result cache')
+    sp = p.add_subparsers()
+
+    p = sp.add_parser('prune', help='evict least recently used entries')
+    p.add_argument('--cache_dir', default=cache.DEFAULT_DIR, help='cache directory [default: %(default)s]')
+    p.add_argument('--max_mb', type=float, default=cache.DEFAULT_MAX_MB, help='size to prune to; 0 clears the cache [default: %(default)s]')
+    p.set_defaults(func='cache.prune')
 
     args = parser.parse_args(args)
     opts = vars(args)
 
-    func = opts.pop('func')
+    if opts.get('cache') is not None and opts.get('seed') is None:
+        parser.error('--cache requires --seed')
+
+    # the cache key hashes the donor list's content, so it must be a file that can be reread
+    if opts.get('cache') is not None and 'donors' in opts and not os.path.isfile(getattr(opts['donors'], 'name', '')):
+        parser.error('--cache needs a donor list in a regular file, not stdin or a pipe')
+
+    func = resolve(opts.pop('func'))
 
     return func, opts
 
+def run(func, opts):
+    seed = opts.pop('seed', None)
+    cache_dir = opts.pop('cache', None)
+    cache_max_mb = opts.pop('cache_max_mb', None)
+
+    if seed is not None:
+        import numpy as np
+        np.random.seed(seed)
+
+    if cache_dir is not None:
+        cache.run(func, opts, func.__name__, seed, cache_dir, cache_max_mb)
+    else:
+        func(**opts)
+
 if __name__ == '__main__':
     func, opts = parse_args()
-    func(**opts)
+    run(func, opts)
@@ -0,0 +1,177 @@
+# author: scott olesen <swo@mit.edu>
+
+'''
+Simulate and analyze trials in one streaming pipeline.
+
+The treatment and placebo arms are simulated in separate processes. Each process runs the
+arm's chunked simulate.write_* function and sends each chunk of history text through a
+bounded queue. The power analysis consumes paired lines as they arrive. Histories, if
+kept, are written by a background thread, so wall time is about the slowest of
+simulation, analysis and I/O rather than their sum.
+'''
+
+import numpy as np
+import multiprocessing, queue, threading, traceback
+from fmt_sim import donors as donors_mod
+from fmt_sim import simulate, analyze
+
+# number of trials sent through a queue at once
+CHUNK_SIZE = 1000
+# number of chunks a queue holds before its producer waits
+QUEUE_SIZE = 8
+# seconds between checks that a quiet producer is still alive
+POLL_INTERVAL = 1.0
+
+STRATEGIES = ['block', 'random', 'urn', 'bayesian', 'thompson', 'greedy']
+
+def count_trials(fn):
+    if fn == '-':
+        raise RuntimeError("the pipeline reads the donor list twice, so it can't come from stdin")
+
+    donors = donors_mod.open_donors(fn)
+    if hasattr(donors, 'donors_per_trial'):
+        return len(donors)
+    else:
+        with donors:
+            return sum(1 for line in donors)
+
+def treatment_kwargs(strategy, donors, n_patients, p_placebo, p_eff, n_donors=None, urn=None, no_replace=False, prior=(1.0, 1.0), ucb=0.0):
+    '''the write function for a strategy and its arguments'''
+    if strategy not in STRATEGIES:
+        raise RuntimeError("don't recognize strategy '{}'".format(strategy))
+
+    if n_donors is not None and strategy in ['urn', 'bayesian']:
+        raise RuntimeError("the {} strategy uses all donors, so n_donors can't be specified".format(strategy))
+
+    kwargs = {'donors': donors, 'n_patients': n_patients, 'p_placebo': p_placebo, 'p_eff': p_eff}
+
+    if strategy in ['block', 'random']:
+        kwargs['n_donors'] = n_donors
+    elif strategy in ['thompson', 'greedy']:
+        kwargs['n_donors'] = n_donors
+        kwargs['prior'] = tuple(prior)
+
+        if strategy == 'greedy':
+            kwargs['ucb'] = ucb
+    elif strategy == 'urn':
+        if urn is None:
+            raise RuntimeError("urn strategy needs initial, reward and penalty ball numbers")
+
+        kwargs['n_balls0'], kwargs['n_balls_reward'], kwargs['n_balls_penalty'] = urn
+        kwargs['no_replace'] = no_replace
+
+    return getattr(simulate, 'write_' + strategy), kwargs
+
+class QueueOutput:
+    '''file-like output that puts each write on a queue'''
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    def write(self, text):
+        self.chunks.put(text)
+
+def produce(chunks, write, kwargs, seed, chunk_size=CHUNK_SIZE):
+    '''put chunks of history text on a queue, then None; an exception if anything fails'''
+    try:
+        np.random.seed(seed)
+
+        if 'donors' in kwargs:
+            kwargs = dict(kwargs, donors=donors_mod.open_donors(kwargs['donors']))
+
+        # the writers make one write per chunk of trials
+        write(output=QueueOutput(chunks), chunk_size=chunk_size, **kwargs)
+        chunks.put(None)
+    except Exception:
+        chunks.put(RuntimeError("simulation failed:\n" + traceback.format_exc()))
+
+class Writer(threading.Thread):
+    '''write chunks of history text to files in the background'''
+    def __init__(self, queue_size=QUEUE_SIZE):
+        super().__init__(daemon=True)
+        self.chunks = queue.Queue(queue_size)
+        self.error = None
+
+    def run(self):
+        while True:
+            item = self.chunks.get()
+            if item is None:
+                break
+
+            output, chunk = item
+            if self.error is None:
+                try:
+                    output.write(chunk)
+                except Exception as e:
+                    # keep draining so the consumer never blocks
+                    self.error = e
+
+    def write(self, output, chunk):
+        self.chunks.put((output, chunk))
+
+    def close(self):
+        self.chunks.put(None)
+        self.join()
+
+        if self.error is not None:
+            raise self.error
+
+def get_chunk(chunks, producer, poll_interval=POLL_INTERVAL):
+    '''next item from a producer's queue, or an error if the producer died without finishing'''
+    while True:
+        try:
+            return chunks.get(timeout=poll_interval)
+        except queue.Empty:
+            if producer.exitcode is None:
+                continue
+
+        # the producer is gone, but its last items may still be in transit
+        try:
+            return chunks.get(timeout=poll_interval)
+        except queue.Empty:
+            raise RuntimeError("simulation process exited with code {} before finishing".format(producer.exitcode))
+
+def consume(chunks, producer, writer=None, output=None, poll_interval=POLL_INTERVAL):
+    '''yield history lines from a producer's queue, passing each chunk to the writer'''
+    while True:
+        chunk = get_chunk(chunks, producer, poll_interval)
+        if chunk is None:
+            break
+        elif isinstance(chunk, Exception):
+            raise chunk
+
+        if output is not None:
+            writer.write(output, chunk)
+
+        yield from chunk.splitlines()
+
+def write_pipeline(strategy, donors, n_patients, p_placebo, p_eff, output, n_donors=None, urn=None, no_replace=False,
+        prior=(1.0, 1.0), ucb=0.0, alphas=[0.05], tests=['fisher'], donor_summary=False, treatment_output=None, placebo_output=None,
+        queue_size=QUEUE_SIZE, chunk_size=CHUNK_SIZE):
+    write, kwargs = treatment_kwargs(strategy, donors, n_patients, p_placebo, p_eff, n_donors, urn, no_replace, prior, ucb)
+    n_trials = count_trials(donors)
+
+    # each arm gets its own stream, drawn from this process's RNG so --seed still works
+    tx_seed, pl_seed = np.random.randint(2 ** 32, size=2, dtype=np.uint64)
+
+    tx_chunks = multiprocessing.Queue(queue_size)
+    pl_chunks = multiprocessing.Queue(queue_size)
+    producers = [
+        multiprocessing.Process(target=produce, args=(tx_chunks, write, kwargs, int(tx_seed), chunk_size), daemon=True),
+        multiprocessing.Process(target=produce, args=(pl_chunks, simulate.write_placebo, {'n_trials': n_trials, 'n_patients': n_patients, 'p_placebo': p_placebo}, int(pl_seed), chunk_size), daemon=True),
+    ]
+
+    writer = Writer(queue_size)
+    writer.start()
+
+    for producer in producers:
+        producer.start()
+
+    try:
+        analyze.write_power(consume(tx_chunks, producers[0], writer, treatment_output), consume(pl_chunks, producers[1], writer, placebo_output), output,
+                alphas=alphas, tests=tests, donors=donor_summary)
+    finally:
+        for producer in producers:
+            producer.terminate()
+            producer.join()
+
+        writer.close()
@@ -9,11 +9,19 @@ of characters. The first character is a donor ID: 'A' means donor 0, 'B' means 1
 (failure).
 
 The placebo trials have one donor marked with character 'P'.
+
+The Thompson and greedy strategies keep a Beta posterior on each donor's success rate.
+Their updates are O(1), so they run vectorized across a chunk of trials at once.
 '''
 
-import numpy as np, itertools
+import numpy as np
 from fmt_sim import donors as donors_mod
-from fmt_sim import bayesian
+
+# number of trials held in memory by the writers
+CHUNK_SIZE = 10000
+
+# histories are written one byte per donor ID character, i.e., chr(65 + ID) <= 255
+MAX_DONOR_ID = 255 - 65
 
 class Urn:
     '''Polya urn'''
@@ -65,90 +73,180 @@ def show_outcome(response, donor_id):
     else:
         raise RuntimeError("don't recognize outcome '{}'".format(response))
 
-def write_placebo(n_trials, n_patients, p_placebo, output):
-    for line in placebo_history(n_trials, n_patients, p_placebo):
-        output.write(line + "\n")
+def fill_histories(buf, donor_is, responses):
+    '''
+    Write donor IDs and responses into the rows of a byte buffer, one row per trial.
+    The last column of the buffer is left for newlines.
+    '''
+    donor_is = np.asarray(donor_is)
+    if donor_is.size > 0:
+        if donor_is.min() < 0:
+            raise RuntimeError("donor IDs should be nonnegative")
+        elif donor_is.max() > MAX_DONOR_ID:
+            raise RuntimeError("donor ID {} is past the last one-byte ID, {}".format(donor_is.max(), MAX_DONOR_ID))
+
+    buf[..., 0:-1:2] = donor_is + 65
+    buf[..., 1:-1:2] = np.where(responses == 1, ord('s'), ord('f'))
+
+def history_buffer(n_trials, n_patients):
+    buf = np.empty((n_trials, 2 * n_patients + 1), dtype=np.uint8)
+    buf[:, -1] = ord('\n')
+    return buf
+
+def decode_histories(buf):
+    # latin-1 keeps the same one-byte-per-character donor IDs as chr()
+    return buf.tobytes().decode('latin-1')
+
+def format_history(donor_is, responses):
+    buf = history_buffer(1, len(donor_is))
+    fill_histories(buf[0], np.asarray(donor_is), np.asarray(responses))
+    return decode_histories(buf[0, :-1])
+
+def write_outcomes(outcomes, n_patients, output, chunk_size=CHUNK_SIZE):
+    '''
+    Write (donor_is, responses) pairs as history lines, with one write per chunk of
+    trials. Memory use depends on chunk_size, not on the number of trials.
+    '''
+    buf = history_buffer(chunk_size, n_patients)
+    row = 0
+    for donor_is, responses in outcomes:
+        fill_histories(buf[row], donor_is, responses)
+        row += 1
+
+        if row == chunk_size:
+            output.write(decode_histories(buf))
+            row = 0
+
+    if row > 0:
+        output.write(decode_histories(buf[0: row]))
+
+def write_outcome_chunks(chunks, n_patients, output, chunk_size=CHUNK_SIZE):
+    '''
+    Write (trials, patients) arrays of donor IDs and responses, each chunk of at most
+    chunk_size trials with one write
+    '''
+    buf = history_buffer(chunk_size, n_patients)
+    for donor_is, responses in chunks:
+        rows = buf[0: len(donor_is)]
+        fill_histories(rows, donor_is, responses)
+        output.write(decode_histories(rows))
+
+def chunk_histories(chunks):
+    '''history lines from (trials, patients) arrays of donor IDs and responses'''
+    for donor_is, responses in chunks:
+        yield from decode_histories(fill_chunk(donor_is, responses)).splitlines()
+
+def fill_chunk(donor_is, responses):
+    buf = history_buffer(*donor_is.shape)
+    fill_histories(buf, donor_is, responses)
+    return buf
+
+def draw_responses(qualities, donor_is, quality2p):
+    '''responses of patients given donor_is[trial, patient] from (trials, donors) qualities'''
+    p = quality2p[np.take_along_axis(qualities, donor_is, axis=1)]
+    return np.random.random(p.shape) < p
+
+def check_n_donors(qualities, n_donors):
+    if n_donors is None:
+        return qualities
+    elif n_donors > len(qualities):
+        raise RuntimeError("n_donors specified as {}, but only {} donors available".format(n_donors, len(qualities)))
+    else:
+        return qualities[0: n_donors]
 
-def placebo_history(n_trials, n_patients, p_placebo):
-    for outcomes in np.random.binomial(1, p_placebo, size=(n_trials, n_patients)):
+def write_placebo(n_trials, n_patients, p_placebo, output, chunk_size=CHUNK_SIZE):
+    buf = history_buffer(chunk_size, n_patients)
+    for responses in placebo_chunks(n_trials, n_patients, p_placebo, chunk_size):
+        rows = buf[0: len(responses)]
         # 15 means 'P'
-        yield "".join([show_outcome(o, 15) for o in outcomes])
+        fill_histories(rows, 15, responses)
+        output.write(decode_histories(rows))
 
-def write_block(donors, n_patients, p_placebo, p_eff, output, n_donors=None):
-    for line in block_history(donors, n_patients, p_placebo, p_eff, n_donors):
-        output.write(line + "\n")
+def placebo_chunks(n_trials, n_patients, p_placebo, chunk_size=CHUNK_SIZE):
+    for start in range(0, n_trials, chunk_size):
+        size = min(chunk_size, n_trials - start)
+        yield np.random.binomial(1, p_placebo, size=(size, n_patients))
 
-def block_history(donors, n_patients, p_placebo, p_eff, n_donors=None):
-    # create a dict that points from patient ID to donor ID
-    # compute the dict by counting the patients while cycling through donors
-    quality2p = {0: p_placebo, 1: p_eff}
+def placebo_history(n_trials, n_patients, p_placebo, chunk_size=CHUNK_SIZE):
+    for responses in placebo_chunks(n_trials, n_patients, p_placebo, chunk_size):
+        for outcomes in responses:
+            yield format_history(np.full(n_patients, 15), outcomes)
 
-    for qualities in donors_mod.parse(donors):
-        if n_donors is not None:
-            if n_donors > len(qualities):
-                raise RuntimeError("n_donors specified as {}, but only {} donors available".format(n_donors, len(qualities)))
-            else:
-                qualities = qualities[0: n_donors]
-
-        history = ""
-        for patient_i, donor_i in zip(range(n_patients), itertools.cycle(range(len(qualities)))):
-            response = np.random.binomial(1, quality2p[qualities[donor_i]])
-            history += show_outcome(response, donor_i)
+def write_block(donors, n_patients, p_placebo, p_eff, output, n_donors=None, chunk_size=CHUNK_SIZE):
+    write_outcome_chunks(block_outcomes(donors, n_patients, p_placebo, p_eff, n_donors, chunk_size), n_patients, output, chunk_size)
 
-        yield history
+def block_outcomes(donors, n_patients, p_placebo, p_eff, n_donors=None, chunk_size=CHUNK_SIZE):
+    quality2p = np.array([p_placebo, p_eff])
 
-def write_random(donors, n_patients, p_placebo, p_eff, output, n_donors=None):
-    for line in random_history(donors, n_patients, p_placebo, p_eff, n_donors):
-        output.write(line + "\n")
+    for qualities in donors_mod.parse_chunks(donors, chunk_size):
+        qualities = check_n_donors(qualities.T, n_donors).T
 
-def random_history(donors, n_patients, p_placebo, p_eff, n_donors=None):
-    quality2p = {0: p_placebo, 1: p_eff}
+        # patient i gets donor i, cycling through the donors
+        donor_is = np.broadcast_to(np.arange(n_patients) % qualities.shape[1], (len(qualities), n_patients))
+        yield donor_is, draw_responses(qualities, donor_is, quality2p)
 
-    for qualities in donors_mod.parse(donors):
-        if n_donors is not None:
-            if n_donors > len(qualities):
-                raise RuntimeError("n_donors specified as {}, but only {} donors available".format(n_donors, len(qualities)))
-            else:
-                qualities = qualities[0: n_donors]
+def block_history(donors, n_patients, p_placebo, p_eff, n_donors=None):
+    yield from chunk_histories(block_outcomes(donors, n_patients, p_placebo, p_eff, n_donors))
 
-        donor_is = np.random.randint(len(qualities), size=n_patients)
-        outcomes = [show_outcome(np.random.binomial(1, quality2p[qualities[donor_i]]), donor_i) for donor_i in donor_is]
-        yield "".join(outcomes)
+def write_random(donors, n_patients, p_placebo, p_eff, output, n_donors=None, chunk_size=CHUNK_SIZE):
+    write_outcome_chunks(random_outcomes(donors, n_patients, p_placebo, p_eff, n_donors, chunk_size), n_patients, output, chunk_size)
 
-def write_urn(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace, output):
-    for line in urn_history(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace):
-        output.write(line + "\n")
+def random_outcomes(donors, n_patients, p_placebo, p_eff, n_donors=None, chunk_size=CHUNK_SIZE):
+    quality2p = np.array([p_placebo, p_eff])
 
-def urn_history(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace):
+    for qualities in donors_mod.parse_chunks(donors, chunk_size):
+        qualities = check_n_donors(qualities.T, n_donors).T
+
+        donor_is = np.random.randint(qualities.shape[1], size=(len(qualities), n_patients))
+        yield donor_is, draw_responses(qualities, donor_is, quality2p)
+
+def random_history(donors, n_patients, p_placebo, p_eff, n_donors=None):
+    yield from chunk_histories(random_outcomes(donors, n_patients, p_placebo, p_eff, n_donors))
+
+def write_urn(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace, output, chunk_size=CHUNK_SIZE):
+    outcomes = urn_outcomes(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace)
+    write_outcomes(outcomes, n_patients, output, chunk_size)
+
+def urn_outcomes(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace):
     quality2p = {0: p_placebo, 1: p_eff}
 
     for qualities in donors_mod.parse(donors):
-        history = ""
         n_donors = len(qualities)
+        donor_is = np.empty(n_patients, dtype=int)
+        responses = np.empty(n_patients, dtype=int)
 
         # initialize urn
         urn = Urn(n_donors, n_balls0, n_balls_reward, n_balls_penalty, not no_replace)
-        
+
         for patient_i in range(n_patients):
             donor_i = urn.choose()
             response = np.random.binomial(1, quality2p[qualities[donor_i]])
             urn.update(response, donor_i)
 
-            history += show_outcome(response, donor_i)
+            donor_is[patient_i] = donor_i
+            responses[patient_i] = response
 
-        yield history
+        yield donor_is, responses
 
-def write_bayesian(donors, n_patients, p_placebo, p_eff, output, n_donors=None):
-    for line in bayesian_history(donors, n_patients, p_placebo, p_eff):
-        output.write(line + "\n")
+def urn_history(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace):
+    outcomes = urn_outcomes(donors, n_patients, p_placebo, p_eff, n_balls0, n_balls_reward, n_balls_penalty, no_replace)
+    for donor_is, responses in outcomes:
+        yield format_history(donor_is, responses)
+
+def write_bayesian(donors, n_patients, p_placebo, p_eff, output, n_donors=None, chunk_size=CHUNK_SIZE):
+    write_outcomes(bayesian_outcomes(donors, n_patients, p_placebo, p_eff), n_patients, output, chunk_size)
+
+def bayesian_outcomes(donors, n_patients, p_placebo, p_eff):
+    # bayesian needs scipy and the C library, so only load it for this strategy
+    from fmt_sim import bayesian
 
-def bayesian_history(donors, n_patients, p_placebo, p_eff):
     quality2p = {0: p_placebo, 1: p_eff}
 
     for qualities in donors_mod.parse(donors):
-        history = ""
-
         n_donors = len(qualities)
+        donor_is = np.empty(n_patients, dtype=int)
+        responses = np.empty(n_patients, dtype=int)
+
         state = [0] * (2 * n_donors)
         for patient_i in range(n_patients):
             donor_i = bayesian.choice(state)
@@ -156,6 +254,66 @@ def bayesian_history(donors, n_patients, p_placebo, p_eff):
 
             state[donor_i * 2 + (1 - response)] += 1
 
-            history += show_outcome(response, donor_i)
+            donor_is[patient_i] = donor_i
+            responses[patient_i] = response
+
+        yield donor_is, responses
+
+def bayesian_history(donors, n_patients, p_placebo, p_eff):
+    for donor_is, responses in bayesian_outcomes(donors, n_patients, p_placebo, p_eff):
+        yield format_history(donor_is, responses)
+
+def choose_max(scores):
+    '''index of the highest score in each row, breaking ties at random'''
+    is_max = scores == scores.max(axis=1, keepdims=True)
+    return np.argmax(is_max * np.random.random(scores.shape), axis=1)
+
+def thompson_scores(a, b, ucb=None):
+    return np.random.beta(a, b)
+
+def greedy_scores(a, b, ucb=0.0):
+    '''posterior mean, plus ucb posterior standard deviations'''
+    mean = a / (a + b)
+    sd = np.sqrt(a * b / ((a + b) ** 2 * (a + b + 1)))
+    return mean + ucb * sd
+
+def beta_outcomes(donors, n_patients, p_placebo, p_eff, scores, prior=(1.0, 1.0), ucb=0.0, n_donors=None, chunk_size=CHUNK_SIZE):
+    '''
+    Assign each patient the donor with the best score under its Beta(successes + prior[0],
+    failures + prior[1]) posterior, for a chunk of trials at a time.
+    '''
+    quality2p = np.array([p_placebo, p_eff])
+
+    for qualities in donors_mod.parse_chunks(donors, chunk_size):
+        qualities = check_n_donors(qualities.T, n_donors).T
+        n_trials, n_donors_used = qualities.shape
+        trial_is = np.arange(n_trials)
+
+        a = np.full((n_trials, n_donors_used), float(prior[0]))
+        b = np.full((n_trials, n_donors_used), float(prior[1]))
+        donor_is = np.empty((n_trials, n_patients), dtype=int)
+        responses = np.empty((n_trials, n_patients), dtype=int)
+
+        for patient_i in range(n_patients):
+            choices = choose_max(scores(a, b, ucb))
+            response = np.random.random(n_trials) < quality2p[qualities[trial_is, choices]]
+
+            a[trial_is, choices] += response
+            b[trial_is, choices] += ~response
+
+            donor_is[:, patient_i] = choices
+            responses[:, patient_i] = response
+
+        yield donor_is, responses
+
+def write_thompson(donors, n_patients, p_placebo, p_eff, output, prior=(1.0, 1.0), n_donors=None, chunk_size=CHUNK_SIZE):
+    write_outcome_chunks(beta_outcomes(donors, n_patients, p_placebo, p_eff, thompson_scores, prior, n_donors=n_donors, chunk_size=chunk_size), n_patients, output, chunk_size)
+
+def thompson_history(donors, n_patients, p_placebo, p_eff, prior=(1.0, 1.0), n_donors=None):
+    yield from chunk_histories(beta_outcomes(donors, n_patients, p_placebo, p_eff, thompson_scores, prior, n_donors=n_donors))
+
+def write_greedy(donors, n_patients, p_placebo, p_eff, output, prior=(1.0, 1.0), ucb=0.0, n_donors=None, chunk_size=CHUNK_SIZE):
+    write_outcome_chunks(beta_outcomes(donors, n_patients, p_placebo, p_eff, greedy_scores, prior, ucb, n_donors, chunk_size), n_patients, output, chunk_size)
 
-        yield history
+def greedy_history(donors, n_patients, p_placebo, p_eff, prior=(1.0, 1.0), ucb=0.0, n_donors=None):
+    yield from chunk_histories(beta_outcomes(donors, n_patients, p_placebo, p_eff, greedy_scores, prior, ucb, n_donors))
@@ -6,6 +6,7 @@ tests for donors.py
 
 import pytest
 import numpy as np, io
+import scipy.stats
 from fmt_sim import analyze
 
 class TestClopper:
@@ -84,3 +85,138 @@ class TestWritePower:
         lo2, center2, hi2 = [float(x) for x in f.read().rstrip().split("\t")]
         for x, y in [[lo, lo2], [center, center2], [hi, hi2]]:
             assert round(x, 3) == round(y, 3)
+
+
+class TestClopperEdges:
+    def test_none(self):
+        lo, hi = analyze.clopper_pearson(0, 10)
+        assert lo == 0.0 and 0.0 < hi < 1.0
+
+    def test_all(self):
+        lo, hi = analyze.clopper_pearson(10, 10)
+        assert 0.0 < lo < 1.0 and hi == 1.0
+
+
+class TestFisherTwoSided:
+    def test_correct(self):
+        # the table is symmetric, so this is twice the one-sided value
+        value = analyze.fisher_exact_p(10, 1, 11, 'two-sided')
+        assert round(value, 6) == 0.000346
+
+
+class TestZTest:
+    def test_correct(self):
+        # cf. half the p-value of an uncorrected chi-squared test on the same table
+        value = analyze.z_test_p(15, 5, 20)
+        assert round(value, 6) == 0.000783
+
+    def test_two_sided(self):
+        assert abs(analyze.z_test_p(15, 5, 20, 'two-sided') - 2 * analyze.z_test_p(15, 5, 20)) < 1e-12
+
+    def test_no_variance(self):
+        assert analyze.z_test_p(0, 0, 20) == 1.0
+
+
+class TestPowerTable:
+    tx_hist = ['AsBs' * 5] * 50 + ['AfBf' * 5] * 50
+    pl_hist = ['PsPf' * 5] * 100
+
+    def test_matches_power(self):
+        rows = analyze.power_table(self.tx_hist, self.pl_hist, alphas=[0.05, 0.01], tests=['fisher', 'z'])
+        power_rows = [row for row in rows if row[0] == 'power']
+        assert [(row[1], row[2]) for row in power_rows] == [('fisher', 0.05), ('fisher', 0.01), ('z', 0.05), ('z', 0.01)]
+
+        for kind, test, alpha, n, x, lo, center, hi in power_rows:
+            assert (lo, center, hi) == analyze.power(self.tx_hist, self.pl_hist, alpha=alpha, test=test)
+
+    def test_donors(self):
+        rows = analyze.power_table(self.tx_hist, self.pl_hist, donors=True)
+        donor_rows = [row for row in rows if row[0] == 'donor']
+        assert [row[1: 5] for row in donor_rows] == [('A', None, 500, 250), ('B', None, 500, 250)]
+
+    def test_no_donors(self):
+        rows = analyze.power_table(self.tx_hist, self.pl_hist)
+        assert [row[0] for row in rows] == ['power']
+
+    def test_bad_test(self):
+        with pytest.raises(RuntimeError):
+            analyze.power_table(self.tx_hist, self.pl_hist, tests=['chisq'])
+
+    def test_write_table(self):
+        f = io.StringIO()
+        analyze.write_power(self.tx_hist, self.pl_hist, f, alphas=[0.05, 0.01], tests=['fisher2'], donors=True)
+        lines = f.getvalue().splitlines()
+        assert lines[0].split("\t") == ['kind', 'name', 'alpha', 'n', 'successes', 'lo', 'estimate', 'hi']
+        assert [line.split("\t")[0] for line in lines[1:]] == ['power', 'power', 'donor', 'donor']
+
+
+class TestStratified:
+    # one donor per trial: stratum 1 trials always succeed, stratum 0 trials never do
+    donors = ["0", "0", "1", "1", "1"]
+    tx_hist = ['Af' * 10] * 2 + ['As' * 10] * 3
+    pl_hist = ['PsPf' * 5] * 5
+
+    def test_by_stratum(self):
+        donors_per_trial, n, x = analyze.power_by_stratum(self.tx_hist, self.pl_hist, self.donors)
+        assert donors_per_trial == 1
+        assert list(n) == [2, 3]
+        assert list(x[('fisher', 0.05)]) == [0, 3]
+
+    def test_by_stratum_n_donors(self):
+        # only the first donor was used, so "01" trials belong in stratum 0
+        donors_per_trial, n, x = analyze.power_by_stratum(['As' * 5, 'Af' * 5], ['Pf' * 5] * 2, ["10", "01"], n_donors=1)
+        assert donors_per_trial == 1
+        assert list(n) == [1, 1]
+        assert list(x[('fisher', 0.05)]) == [0, 1]
+
+    def test_by_stratum_too_many_donors(self):
+        with pytest.raises(RuntimeError):
+            analyze.power_by_stratum(self.tx_hist, self.pl_hist, self.donors, n_donors=2)
+
+    def test_by_stratum_bad_test(self):
+        with pytest.raises(RuntimeError):
+            analyze.power_by_stratum(self.tx_hist, self.pl_hist, self.donors, tests=['chisq'])
+
+    def test_ci_one_stratum(self):
+        # with all the weight in one stratum, this is the usual interval
+        lo, center, hi = analyze.stratified_ci([0, 50], [10, 100], [0.0, 1.0])
+        assert center == 0.5
+        assert np.allclose((lo, hi), analyze.clopper_pearson(50, 100))
+
+    def test_ci_df_adjustment(self):
+        # same effective size, but more strata leave fewer degrees of freedom
+        lo2, center2, hi2 = analyze.stratified_ci([2, 2], [4, 4], [0.5, 0.5])
+        lo4, center4, hi4 = analyze.stratified_ci([1, 1, 1, 1], [2, 2, 2, 2], [0.25] * 4)
+        assert center2 == center4 == 0.5
+        assert lo4 < lo2 and hi2 < hi4
+
+    def test_ci_combined(self):
+        lo, center, hi = analyze.stratified_ci([0, 3], [2, 3], [0.7, 0.3])
+        assert abs(center - 0.3) < 1e-12
+        # neither stratum varies, so the effective size falls back to all 5 trials,
+        # scaled for 5 - 2 degrees of freedom
+        n_eff = 5 * (scipy.stats.t.ppf(0.975, 4) / scipy.stats.t.ppf(0.975, 3)) ** 2
+        assert np.allclose((lo, hi), analyze.clopper_pearson(center * n_eff, n_eff))
+
+    def test_ci_missing_stratum(self):
+        with pytest.raises(RuntimeError):
+            analyze.stratified_ci([0, 3], [0, 3], [0.5, 0.5])
+
+    def test_reweight(self):
+        f = io.StringIO()
+        analyze.write_stratified_power(self.tx_hist, self.pl_hist, self.donors, [0.25], f)
+        f.seek(0)
+        lines = f.readlines()
+        assert [line.split("\t")[0] for line in lines[1:]] == ['stratum', 'stratum', 'power']
+        assert float(lines[-1].split("\t")[8]) == 0.25
+        # the weighted estimate isn't a count, so there are no combined successes
+        assert lines[-1].split("\t")[6] == 'NA'
+
+        g = io.StringIO()
+        analyze.write_reweighted(lines, [0.25, 0.5], g)
+        rows = [line.split("\t") for line in g.getvalue().splitlines()[1:]]
+        assert [(float(row[3]), float(row[8])) for row in rows] == [(0.25, 0.25), (0.5, 0.5)]
+
+    def test_reweight_bad_table(self):
+        with pytest.raises(RuntimeError):
+            list(analyze.parse_stratum_table(["lo\tcenter\thi\n"]))
@@ -0,0 +1,83 @@
+# author: scott olesen <swo@mit.edu>
+
+'''
+tests for cache.py
+'''
+
+import pytest
+import numpy as np, io, os
+from fmt_sim import cache, simulate
+
+def run_placebo(cache_dir, seed, **kwargs):
+    np.random.seed(seed)
+    f = io.StringIO()
+    opts = dict(n_trials=20, n_patients=5, p_placebo=0.5, output=f)
+    hit = cache.run(simulate.write_placebo, opts, 'write_placebo', seed, cache_dir, **kwargs)
+    return hit, f.getvalue()
+
+class TestKey:
+    def test_params_matter(self):
+        assert cache.key('a', {'x': 1}, 0) != cache.key('a', {'x': 2}, 0)
+
+    def test_seed_matters(self):
+        assert cache.key('a', {'x': 1}, 0) != cache.key('a', {'x': 1}, 1)
+
+    def test_no_seed(self):
+        with pytest.raises(RuntimeError):
+            cache.key('a', {'x': 1}, None)
+
+    def test_donor_content(self, tmp_path):
+        fn = str(tmp_path / 'donors.txt')
+        with open(fn, 'w') as f:
+            f.write("010\n")
+        with open(fn) as f:
+            key1 = cache.key('a', {}, 0, f)
+
+        with open(fn, 'w') as f:
+            f.write("011\n")
+        with open(fn) as f:
+            key2 = cache.key('a', {}, 0, f)
+
+        assert key1 != key2
+
+    def test_donor_not_file(self):
+        with pytest.raises(RuntimeError):
+            cache.key('a', {}, 0, ["010"])
+
+
+class TestRun:
+    def test_hit(self, tmp_path):
+        hit1, out1 = run_placebo(str(tmp_path), 0)
+        hit2, out2 = run_placebo(str(tmp_path), 0)
+        assert (hit1, hit2) == (False, True)
+        assert out1 == out2
+        assert len(out1.splitlines()) == 20
+
+    def test_miss_other_seed(self, tmp_path):
+        run_placebo(str(tmp_path), 0)
+        hit, out = run_placebo(str(tmp_path), 1)
+        assert not hit
+
+
+class TestPrune:
+    def test_lru(self, tmp_path):
+        cache_dir = str(tmp_path)
+        for seed in range(3):
+            run_placebo(cache_dir, seed)
+
+        # make seed 0 the oldest, then use it, making seed 1 the oldest
+        paths = sorted(cache.entries(cache_dir), key=lambda e: e[2])
+        for i, (path, size, mtime) in enumerate(paths):
+            os.utime(path, (i, i))
+        run_placebo(cache_dir, 0)
+        survivors = {path for path, size, mtime in cache.entries(cache_dir)}
+
+        size = paths[0][1]
+        assert cache.prune(cache_dir, max_mb=2.5 * size / (1 << 20)) == 1
+        evicted = survivors - {path for path, size, mtime in cache.entries(cache_dir)}
+        assert evicted == {paths[1][0]}
+
+    def test_clear(self, tmp_path):
+        run_placebo(str(tmp_path), 0)
+        cache.prune(str(tmp_path), max_mb=0)
+        assert cache.entries(str(tmp_path)) == []
@@ -5,7 +5,7 @@ tests for donors.py
 '''
 
 import pytest
-import io, warnings
+import numpy as np, io, warnings
 from fmt_sim import donors
 
 class TestGenerate:
@@ -35,6 +35,11 @@ class TestParse:
         with pytest.raises(ValueError):
             list(donors.parse(lst))
 
+    def test_fail_superscript(self):
+        # superscript 2 is a digit, but not one int() accepts
+        with pytest.raises(ValueError):
+            list(donors.parse(["0\u00b2\n"]))
+
     def test_fail_run(self):
         lst = ["555\n"]
         with pytest.raises(RuntimeError):
@@ -66,3 +71,108 @@ class TestWrite:
         for line in lines:
             assert len(line) == 5
             assert set(line) <= {'0', '1'}
+
+
+class TestGenerateChunks:
+    def test_chunked_length(self):
+        lst = list(donors.generate(4, 25, 0.5, chunk_size=10))
+        assert len(lst) == 25
+        for line in lst:
+            assert len(line.rstrip()) == 4
+
+    def test_chunk_sizes(self):
+        chunks = list(donors.generate_chunks(4, 25, 0.5, chunk_size=10))
+        assert [c.shape for c in chunks] == [(10, 4), (10, 4), (5, 4)]
+
+
+class TestPacked:
+    def write_packed(self, tmp_path, donors_per_trial, n_trials, ped, chunk_size=donors.CHUNK_SIZE):
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(donors_per_trial, n_trials, ped, f, packed=True, chunk_size=chunk_size)
+        return fn
+
+    def test_header(self, tmp_path):
+        fn = self.write_packed(tmp_path, 10, 7, 0.5)
+        packed = donors.PackedDonors(fn)
+        assert (packed.donors_per_trial, len(packed)) == (10, 7)
+
+    def test_parse_all_good(self, tmp_path):
+        fn = self.write_packed(tmp_path, 11, 25, 1.0, chunk_size=10)
+        lst = list(donors.parse(donors.PackedDonors(fn, chunk_size=4)))
+        assert lst == [[1] * 11] * 25
+
+    def test_matches_text(self, tmp_path):
+        np.random.seed(0)
+        text = io.StringIO()
+        donors.write(13, 20, 0.5, text)
+        text.seek(0)
+
+        np.random.seed(0)
+        fn = self.write_packed(tmp_path, 13, 20, 0.5)
+
+        assert list(donors.parse(text)) == list(donors.parse(donors.PackedDonors(fn)))
+
+    def test_open_sniffs_format(self, tmp_path):
+        fn = self.write_packed(tmp_path, 3, 2, 0.5)
+        assert isinstance(donors.open_donors(fn), donors.PackedDonors)
+
+        text_fn = str(tmp_path / 'donors.txt')
+        with open(text_fn, 'w') as f:
+            f.write("010\n")
+        with donors.open_donors(text_fn) as f:
+            assert list(donors.parse(f)) == [[0, 1, 0]]
+
+    def test_bad_magic(self, tmp_path):
+        fn = str(tmp_path / 'donors.txt')
+        with open(fn, 'w') as f:
+            f.write("0" * 40 + "\n")
+        with pytest.raises(RuntimeError):
+            donors.PackedDonors(fn)
+
+
+class TestParseChunks:
+    def test_text(self):
+        lst = ["010\n", "110\n", "1\n", "0\n", "1\n"]
+        chunks = [c.tolist() for c in donors.parse_chunks(lst, chunk_size=2)]
+        assert chunks == [[[0, 1, 0], [1, 1, 0]], [[1], [0]], [[1]]]
+
+    def test_packed_chunk_size(self, tmp_path):
+        # the caller's chunk size wins over the one the list was opened with
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(5, 25, 0.5, f, packed=True)
+
+        chunks = list(donors.parse_chunks(donors.PackedDonors(fn, chunk_size=4), chunk_size=10))
+        assert [len(c) for c in chunks] == [10, 10, 5]
+
+
+class TestStratified:
+    def test_weights(self):
+        weights = donors.stratum_weights(3, 0.5)
+        assert list(weights) == [0.125, 0.375, 0.375, 0.125]
+
+    def test_allocate_equal(self):
+        assert list(donors.allocate(3, 10, 0.5, 'equal')) == [3, 3, 2, 2]
+
+    def test_allocate_proportional(self):
+        assert list(donors.allocate(3, 8, 0.5, 'proportional')) == [1, 3, 3, 1]
+
+    def test_allocate_keeps_small_strata(self):
+        counts = donors.allocate(5, 100, 0.1, 'proportional')
+        assert all(counts > 0)
+
+    def test_allocate_bad(self):
+        with pytest.raises(RuntimeError):
+            donors.allocate(3, 10, 0.5, 'neyman')
+
+    def test_exact_k(self):
+        chunks = list(donors.generate_stratified_chunks(6, [2, 0, 3, 0, 0, 0, 1], chunk_size=2))
+        ks = [int(row.sum()) for chunk in chunks for row in chunk]
+        assert ks == [0, 0, 2, 2, 2, 6]
+
+    def test_write(self):
+        f = io.StringIO()
+        donors.write(4, 10, 0.5, f, stratify='equal')
+        lines = f.getvalue().splitlines()
+        assert [line.count('1') for line in lines] == [0, 0, 1, 1, 2, 2, 3, 3, 4, 4]
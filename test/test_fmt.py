@@ -0,0 +1,134 @@
+# author: scott olesen <swo@mit.edu>
+
+'''
+tests for fmt.py
+'''
+
+import pytest
+import os, subprocess, sys
+
+FMT = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'fmt.py')
+
+# wall-clock budget for all imports, in seconds; numpy alone takes ~0.1 s, so
+# this is generous enough for slow machines but catches scipy sneaking back in
+IMPORT_BUDGET = 1.0
+# budget for commands that need scipy, which alone takes ~1.5 s on a cold start
+SCIPY_IMPORT_BUDGET = 3.0
+
+def imports(args, tmp_path):
+    '''names and total cumulative time (s) of modules imported while running fmt.py'''
+    result = subprocess.run([sys.executable, '-X', 'importtime', FMT] + args, cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, check=True)
+
+    names = set()
+    total_us = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        names.add(name.strip())
+        # nested imports are indented past the single separating space
+        if not name.startswith('  '):
+            total_us += int(cumulative_us)
+
+    return names, total_us / 1e6
+
+@pytest.fixture
+def donor_file(tmp_path):
+    fn = str(tmp_path / 'donors.txt')
+    with open(fn, 'w') as f:
+        f.write("010\n" * 5)
+    return fn
+
+@pytest.fixture
+def analysis_files(tmp_path):
+    '''stratified donor list, paired histories, and a stratified power table'''
+    contents = {
+        'donors.txt': "00\n01\n11\n",
+        'tx.txt': "AsBf\nAfBs\nAsBs\n",
+        'pl.txt': "PsPf\nPfPf\nPfPf\n",
+        'strata.txt': "\n".join([
+            "\t".join(['kind', 'test', 'alpha', 'ped', 'k', 'n', 'successes', 'lo', 'estimate', 'hi']),
+            "\t".join(['stratum', 'fisher', '0.05', 'NA', '0', '1', '0', '0.0', '0.0', '0.975']),
+            "\t".join(['stratum', 'fisher', '0.05', 'NA', '1', '1', '0', '0.0', '0.0', '0.975']),
+            "\t".join(['stratum', 'fisher', '0.05', 'NA', '2', '1', '1', '0.025', '1.0', '1.0']),
+        ]) + "\n",
+    }
+
+    for fn, content in contents.items():
+        with open(str(tmp_path / fn), 'w') as f:
+            f.write(content)
+
+class TestStartup:
+    @pytest.mark.parametrize('args', [
+        ['donors', '3', '5', '0.5'],
+        ['simulate', 'placebo', '5', '4', '0.5'],
+        ['simulate', 'block', 'DONORS', '4', '0.1', '0.9'],
+        ['simulate', 'random', 'DONORS', '4', '0.1', '0.9'],
+        ['simulate', 'urn', 'DONORS', '4', '0.1', '0.9', '1', '1', '1'],
+        ['simulate', 'thompson', 'DONORS', '4', '0.1', '0.9'],
+        ['simulate', 'greedy', 'DONORS', '4', '0.1', '0.9', '--ucb', '1'],
+        ['cache', 'prune', '--cache_dir', 'cache'],
+    ])
+    def test_no_scipy(self, args, donor_file, tmp_path):
+        args = [donor_file if a == 'DONORS' else a for a in args]
+        names, seconds = imports(args, tmp_path)
+        assert 'scipy' not in names
+        assert 'fmt_sim.bayesian' not in names
+        assert seconds < IMPORT_BUDGET
+
+    @pytest.mark.parametrize('args', [
+        ['power', 'tx.txt', 'pl.txt'],
+        ['power', 'tx.txt', 'pl.txt', '--tests', 'fisher', 'z', '--donors'],
+        ['stratified_power', 'tx.txt', 'pl.txt', 'donors.txt', '--peds', '0.5'],
+        ['reweight', 'strata.txt', '--peds', '0.3'],
+        ['pipeline', 'random', 'donors.txt', '2', '0.1', '0.9'],
+    ])
+    def test_analysis(self, args, analysis_files, tmp_path):
+        names, seconds = imports(args, tmp_path)
+        assert 'fmt_sim.bayesian' not in names
+        assert seconds < SCIPY_IMPORT_BUDGET
+
+    def test_bayesian(self, analysis_files, tmp_path):
+        names, seconds = imports(['simulate', 'bayesian', 'donors.txt', '2', '0.1', '0.9'], tmp_path)
+        assert 'fmt_sim.bayesian' in names
+        assert seconds < SCIPY_IMPORT_BUDGET
+
+    def test_cache_needs_no_numpy(self, tmp_path):
+        names, seconds = imports(['cache', 'prune', '--cache_dir', 'cache'], tmp_path)
+        assert 'numpy' not in names
+
+
+class TestDonorList:
+    def test_missing_file(self, tmp_path):
+        result = subprocess.run([sys.executable, FMT, 'simulate', 'random', 'nonexistent.txt', '4', '0.1', '0.9'], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert result.returncode == 2
+        assert "can't open 'nonexistent.txt'" in result.stderr
+        assert 'Traceback' not in result.stderr
+
+    def test_pipeline_missing_file(self, tmp_path):
+        result = subprocess.run([sys.executable, FMT, 'pipeline', 'random', 'nonexistent.txt', '4', '0.1', '0.9'], cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert result.returncode == 2
+        assert "can't open 'nonexistent.txt'" in result.stderr
+        assert 'Traceback' not in result.stderr
+
+    def test_pipe(self, tmp_path):
+        # sniffing for the packed format mustn't eat the start of a pipe
+        result = subprocess.run([sys.executable, FMT, 'simulate', 'block', '/dev/stdin', '4', '0', '1'], input="10\n" * 3, cwd=str(tmp_path), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        assert result.stdout.splitlines() == ["AsBfAsBf"] * 3
+
+
+class TestCacheArgs:
+    def test_stdin_donors(self, tmp_path):
+        result = subprocess.run([sys.executable, FMT, 'simulate', 'block', '-', '4', '0.1', '0.9', '--seed', '1', '--cache', 'cache'], input="10\n", cwd=str(tmp_path), stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+        assert result.returncode == 2
+        assert '--cache' in result.stderr
+        assert 'Traceback' not in result.stderr
+
+
+class TestTests:
+    def test_match_analyze(self):
+        # fmt.py lists the test names itself to avoid importing scipy at startup
+        from fmt_sim import analyze
+        result = subprocess.run([sys.executable, '-c', 'import fmt; print(" ".join(fmt.TESTS))'], cwd=os.path.dirname(FMT), stdout=subprocess.PIPE, universal_newlines=True, check=True)
+        assert sorted(result.stdout.split()) == sorted(analyze.TESTS)
@@ -0,0 +1,112 @@
+# author: scott olesen <swo@mit.edu>
+
+'''
+tests for pipeline.py
+'''
+
+import pytest
+import numpy as np, io, multiprocessing, os, signal
+from fmt_sim import pipeline, donors
+
+def killed_write(output, chunk_size):
+    # dies like an OOM kill, with no chance to report an exception
+    output.write("As\n")
+    os.kill(os.getpid(), signal.SIGKILL)
+
+@pytest.fixture
+def donor_file(tmp_path):
+    fn = str(tmp_path / 'donors.txt')
+    with open(fn, 'w') as f:
+        f.write("100\n" * 25)
+    return fn
+
+class TestCountTrials:
+    def test_text(self, donor_file):
+        assert pipeline.count_trials(donor_file) == 25
+
+    def test_stdin(self):
+        with pytest.raises(RuntimeError):
+            pipeline.count_trials('-')
+
+
+class TestTreatmentKwargs:
+    def test_urn_needs_balls(self):
+        with pytest.raises(RuntimeError):
+            pipeline.treatment_kwargs('urn', 'donors.txt', 10, 0.1, 0.9)
+
+    def test_greedy(self):
+        write, kwargs = pipeline.treatment_kwargs('greedy', 'donors.txt', 10, 0.1, 0.9, prior=[2, 2], ucb=1.0)
+        assert (kwargs['prior'], kwargs['ucb']) == ((2, 2), 1.0)
+
+    @pytest.mark.parametrize('strategy', ['urn', 'bayesian'])
+    def test_n_donors_unsupported(self, strategy):
+        with pytest.raises(RuntimeError):
+            pipeline.treatment_kwargs(strategy, 'donors.txt', 10, 0.1, 0.9, n_donors=2, urn=[1, 1, 1])
+
+    def test_bad_strategy(self):
+        with pytest.raises(RuntimeError):
+            pipeline.treatment_kwargs('magic', 'donors.txt', 10, 0.1, 0.9)
+
+
+class TestWritePipeline:
+    def test_full_power(self, donor_file):
+        # donor A always works and placebo never does
+        f = io.StringIO()
+        pipeline.write_pipeline('block', donor_file, 9, 0.0, 1.0, f, n_donors=1, chunk_size=4, queue_size=2)
+        lo, center, hi = [float(x) for x in f.getvalue().split("\t")]
+        assert center == 1.0
+
+    def test_packed(self, tmp_path):
+        # more trials than one pipeline chunk, fewer than one packed donor list chunk
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(3, 1500, 1.0, f, packed=True)
+
+        f = io.StringIO()
+        pipeline.write_pipeline('thompson', fn, 4, 0.0, 1.0, f)
+        lo, center, hi = [float(x) for x in f.getvalue().split("\t")]
+        assert center == 1.0
+
+    def test_keeps_histories(self, donor_file, tmp_path):
+        tx_fn = str(tmp_path / 'tx.txt')
+        pl_fn = str(tmp_path / 'pl.txt')
+        with open(tx_fn, 'w') as tx, open(pl_fn, 'w') as pl:
+            pipeline.write_pipeline('urn', donor_file, 6, 0.0, 1.0, io.StringIO(), urn=[1, 1, 1],
+                    treatment_output=tx, placebo_output=pl, chunk_size=4)
+
+        with open(tx_fn) as tx, open(pl_fn) as pl:
+            tx_lines = tx.read().splitlines()
+            pl_lines = pl.read().splitlines()
+
+        assert len(tx_lines) == len(pl_lines) == 25
+        assert set(pl_lines) == {"Pf" * 6}
+
+    def test_seeded(self, donor_file):
+        outputs = []
+        for i in range(2):
+            np.random.seed(0)
+            f = io.StringIO()
+            pipeline.write_pipeline('random', donor_file, 6, 0.3, 0.8, f)
+            outputs.append(f.getvalue())
+
+        assert outputs[0] == outputs[1]
+
+    def test_producer_error(self, tmp_path):
+        fn = str(tmp_path / 'donors.txt')
+        with open(fn, 'w') as f:
+            f.write("555\n")
+
+        with pytest.raises(RuntimeError):
+            pipeline.write_pipeline('random', fn, 6, 0.3, 0.8, io.StringIO())
+
+
+class TestConsume:
+    def test_killed_producer(self):
+        chunks = multiprocessing.Queue(2)
+        producer = multiprocessing.Process(target=pipeline.produce, args=(chunks, killed_write, {}, 0, 1), daemon=True)
+        producer.start()
+
+        with pytest.raises(RuntimeError):
+            list(pipeline.consume(chunks, producer, poll_interval=0.1))
+
+        producer.join()
@@ -6,7 +6,7 @@ tests for donors.py
 
 import pytest
 import numpy as np, io, re
-from fmt_sim import simulate
+from fmt_sim import simulate, donors
 
 @pytest.fixture
 def urn():
@@ -51,6 +51,34 @@ class TestShowOutcome:
             simulate.show_outcome('a', 0)
 
 
+class TestFormatHistory:
+    def test_correct(self):
+        assert simulate.format_history([0, 1, 2], [1, 0, 1]) == "AsBfCs"
+
+    def test_fail(self):
+        with pytest.raises(RuntimeError):
+            simulate.format_history([-1], [1])
+
+    def test_last_byte(self):
+        assert simulate.format_history([190], [1]) == simulate.show_outcome(1, 190)
+
+    def test_past_last_byte(self):
+        with pytest.raises(RuntimeError):
+            simulate.format_history([191], [1])
+
+    def test_write_many_donors(self):
+        with pytest.raises(RuntimeError):
+            simulate.write_block(["0" * 200], 200, 0.5, 0.5, io.StringIO())
+
+
+class TestWriteOutcomes:
+    def test_chunked(self):
+        outcomes = [(np.array([0, 1]), np.array([1, 0]))] * 7
+        f = io.StringIO()
+        simulate.write_outcomes(outcomes, 2, f, chunk_size=3)
+        assert f.getvalue() == "AsBf\n" * 7
+
+
 class TestPlaceboHistory:
     def test_correct_all(self):
         history = list(simulate.placebo_history(100, 10, 1.0))
@@ -85,6 +113,11 @@ class TestPlaceboWrite:
             assert set(line[::2]) == {'P'}
             assert set(line[1::2]) <= {'s', 'f'}
 
+    def test_chunked(self):
+        f = io.StringIO()
+        simulate.write_placebo(25, 3, 1.0, f, chunk_size=10)
+        assert f.getvalue() == "PsPsPs\n" * 25
+
 
 class TestBlockHistory:
     def test_correct(self):
@@ -133,6 +166,14 @@ class TestRandomWrite:
             assert set(line[1::2]) <= {'s', 'f'}
 
 
+class TestBlockChunks:
+    def test_mixed_donor_counts(self):
+        # trials with different numbers of donors land in different chunks
+        f = io.StringIO()
+        simulate.write_block(["10", "10", "10", "100", "1"], 4, 0.0, 1.0, f, chunk_size=2)
+        assert f.getvalue().splitlines() == ["AsBfAsBf"] * 3 + ["AsBfCfAs", "AsAsAsAs"]
+
+
 class TestRandomHistory:
     def test_correct(self):
         donors = ["".join(np.random.choice(['0', '1'], size=3)) for i in range(20)]
@@ -181,3 +222,87 @@ class TestBayesianHistory:
         assert len(history) == 2
         for line in history:
             assert len(line) == 10
+
+
+class TestPackedDonors:
+    def test_block(self, tmp_path):
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(3, 4, 1.0, f, packed=True)
+
+        history = list(simulate.block_history(donors.PackedDonors(fn), 6, 0.0, 1.0))
+        assert history == ["AsBsCsAsBsCs"] * 4
+
+    @pytest.mark.parametrize('write', ['write_thompson', 'write_greedy'])
+    def test_chunk_size(self, write, tmp_path):
+        # the writer's chunk size, not the one the list was opened with, sizes each chunk
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(3, 25, 0.5, f, packed=True)
+
+        f = io.StringIO()
+        getattr(simulate, write)(donors.PackedDonors(fn), 6, 0.2, 0.8, f, chunk_size=10)
+        assert len(f.getvalue().splitlines()) == 25
+
+
+class TestChooseMax:
+    def test_correct(self):
+        scores = np.array([[0.1, 0.5, 0.2], [0.9, 0.0, 0.0]])
+        assert list(simulate.choose_max(scores)) == [1, 0]
+
+    def test_ties(self):
+        scores = np.zeros((200, 2))
+        assert set(simulate.choose_max(scores)) == {0, 1}
+
+
+class TestGreedyScores:
+    def test_mean(self):
+        assert simulate.greedy_scores(np.array([3.0]), np.array([1.0]))[0] == 0.75
+
+    def test_ucb(self):
+        a, b = np.array([3.0]), np.array([1.0])
+        assert simulate.greedy_scores(a, b, ucb=1.0)[0] > 0.75
+
+
+class TestThompsonHistory:
+    def test_correct(self):
+        donors = ["".join(np.random.choice(['0', '1'], size=3)) for i in range(20)]
+        history = list(simulate.thompson_history(donors, 8, 0.25, 0.5))
+        assert len(history) == 20
+        for h in history:
+            assert len(h) == 16
+            assert set(h[::2]) <= {'A', 'B', 'C'}
+            assert set(h[1::2]) <= {'s', 'f'}
+
+    def test_limited(self):
+        history = list(simulate.thompson_history(["100"] * 5, 8, 0.0, 1.0, n_donors=2))
+        for h in history:
+            assert set(re.findall('..', h)) <= {'As', 'Bf'}
+
+
+class TestGreedyHistory:
+    def test_finds_good_donor(self):
+        # after donor A's first success, the greedy rule never leaves it
+        history = list(simulate.greedy_history(["100"] * 10, 10, 0.0, 1.0))
+        for h in history:
+            assert h.endswith('As' * 5)
+
+    def test_mixed_donor_counts(self):
+        history = list(simulate.greedy_history(["10", "100", "1"], 4, 0.0, 1.0, ucb=1.0))
+        assert [set(h[::2]) <= set('ABC'[0: n]) for h, n in zip(history, [2, 3, 1])] == [True] * 3
+
+
+class TestThompsonWrite:
+    def test_packed(self, tmp_path):
+        fn = str(tmp_path / 'donors.bin')
+        with open(fn, 'wb') as f:
+            donors.write(4, 25, 0.5, f, packed=True)
+
+        # the list is opened with a bigger chunk size than the writer's buffer
+        f = io.StringIO()
+        simulate.write_thompson(donors.PackedDonors(fn, chunk_size=100), 6, 0.2, 0.8, f, chunk_size=10)
+        lines = f.getvalue().splitlines()
+        assert len(lines) == 25
+        for line in lines:
+            assert len(line) == 12
+            assert set(line[::2]) <= {'A', 'B', 'C', 'D'}